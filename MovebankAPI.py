@@ -1,79 +1,270 @@
-import csv
+import bisect
+import functools
 import hashlib
 import io
 import json
 import os
 import requests
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlencode
+from urllib3.util.retry import Retry
 
+import ciso8601
 import dateparser
 import keyring
 import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:  # optional, large responses are parsed by pandas then
+    pacsv = None
+
+try:
+    from numba import njit
+except ImportError:  # optional, ACC samples are converted by NumPy then
+    njit = None
+
+_DIRECT_READ_URL = 'https://www.movebank.org/movebank/service/direct-read'
+# bytes read up front to look for license terms in a streamed response
+_LICENSE_PEEK = 1 << 16
+# responses above this size are parsed with pyarrow, if installed; for a
+# streamed response this is the size on the wire (Content-Length), i.e. the
+# compressed size when the server gzips the body
+_ARROW_MIN_BYTES = 8 << 20
+
+# e-obs acceleration slopes: (last tag_local_identifier of a generation,
+# slope per sensitivity); later generations use 1 / 512
+_SLOPE_TABLE = [
+    (2241, {'low': 0.0027, 'high': 0.001}),  # 1st generation
+    (4117, {'low': 0.0022, 'high': 0.0022}),  # 2nd generation
+]
+_SLOPE_BOUNDS = [bound for bound, _ in _SLOPE_TABLE]
+
+
+def _pick_slope(tag_local_identifier, sensitivity):
+    i = bisect.bisect_left(_SLOPE_BOUNDS, tag_local_identifier)
+    if i == len(_SLOPE_TABLE):
+        return 1 / 512
+    slopes = _SLOPE_TABLE[i][1]
+    return slopes.get(sensitivity, slopes['high'])
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_ts(ts):
+    return ciso8601.parse_datetime(ts)
+
+
+if njit is not None:
+
+    # not parallel=True: getAllIndividualEvents calls this from several
+    # threads, which Numba's default workqueue layer does not allow
+    @njit(fastmath=True)
+    def _acc_convert(raw, offset, scale, out_x, out_y, out_z):
+        # de-interleave X Y Z X Y Z ... and scale, in one pass over memory
+        for i in range(raw.shape[0] // 3):
+            out_x[i] = (raw[3 * i] - offset) * scale
+            out_y[i] = (raw[3 * i + 1] - offset) * scale
+            out_z[i] = (raw[3 * i + 2] - offset) * scale
+else:
+
+    def _acc_convert(raw, offset, scale, out_x, out_y, out_z):
+        for out, axis in zip((out_x, out_y, out_z), raw.reshape(-1, 3).T):
+            np.subtract(axis, offset, out=out)
+            out *= scale
+
+
+class _ResponseStream(io.RawIOBase):
+    # Readable view of a streamed response that first replays the bytes
+    # already read for the license check.
+
+    def __init__(self, head, response):
+        self._head = head
+        self._raw = response.raw
+        # encoded (possibly gzipped) size; 0 if the server streams the body
+        # without announcing its length
+        self.length = int(response.headers.get('Content-Length') or 0)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._head:
+            n = min(len(b), len(self._head))
+            b[:n] = self._head[:n]
+            self._head = self._head[n:]
+            return n
+        return self._raw.readinto(b)
+
 
 class MovebankAPI:
     def __init__(self, username, password, study_id=None):
         self.username = username
         self.password = password
         self.study_id = study_id
+        # one pooled session, so consecutive calls reuse the TLS connection
+        self._session = requests.Session()
+        self._session.mount(
+            'https://',
+            HTTPAdapter(pool_connections=16,
+                        pool_maxsize=32,
+                        max_retries=Retry(total=3, backoff_factor=0.3)))
+        self._session.auth = (username, password)
+        # URL, session headers and auth are prepared once, calls only swap
+        # the query string and cookies
+        self._prep_base = self._session.prepare_request(
+            requests.Request('GET', _DIRECT_READ_URL))
+        # proxies and CA bundle from the environment, as session.get uses
+        self._send_kw = self._session.merge_environment_settings(
+            _DIRECT_READ_URL, {}, True, None, None)
+        # license-md5 of the terms already accepted, per study_id
+        self._license_cache = {}
+        # parsed study and individual listings, see invalidate()
+        self._cache = {}
+
+    def invalidate(self):
+        # forget cached studies and individuals, the next calls refetch them
+        self._cache.clear()
+
+    def _get(self, params):
+        req = self._prep_base.copy()
+        req.url = _DIRECT_READ_URL + '?' + urlencode(params)
+        req.prepare_cookies(self._session.cookies)
+        return self._session.send(req, **self._send_kw)
 
     def callMovebankAPI(self, params):
         """"
 		params: Requests Movebank API with ((param1, value1), (param2, value2),).
-		Return the API response as plain text.
+		Return the API response as a binary stream that is read while it
+		downloads, or b'' if the request failed or returned no data.
 		"""
-        response = requests.get(
-            'https://www.movebank.org/movebank/service/direct-read',
-            params=params,
-            auth=(self.username, self.password))
+        study_id = dict(params).get('study_id')
+        license_md5 = self._license_cache.get(study_id)
+        response = self._get(params + (('license-md5', license_md5), )
+                             if license_md5 else params)
         print("Request " + response.url)
+        if license_md5 and response.status_code != 200:
+            # the terms may have changed since they were accepted, retry once
+            # without the cached hash
+            print("Cached license hash rejected")
+            response.close()
+            self._license_cache.pop(study_id, None)
+            return self.callMovebankAPI(params)
         if response.status_code == 200:  # successful request
-            if 'License Terms:' in str(response.content):
+            response.raw.decode_content = True
+            head = response.raw.read(_LICENSE_PEEK)
+            if (response.headers.get('accept-license') == 'true'
+                    or b'License Terms:' in head):
                 # only the license terms are returned, hash and append them in a
                 # subsequent request.
                 # See also
                 # https://github.com/movebank/movebank-api-doc/blob/master/movebank
                 # api.md#read-and-accept-license-terms-using-curl
                 print("Has license terms")
-                hash = hashlib.md5(response.content).hexdigest()
+                hash = hashlib.md5(head + response.raw.read(),
+                                   usedforsecurity=False).hexdigest()
                 params = params + (('license-md5', hash), )
-                # also attach previous cookie:
-                response = requests.get(
-                    'https://www.movebank.org/movebank/service/direct-read',
-                    params=params,
-                    cookies=response.cookies,
-                    auth=(self.username, self.password))
+                # the session also attaches the previous cookie:
+                response = self._get(params)
                 if response.status_code == 403:  # incorrect hash
                     print("Incorrect hash")
-                    return ''
-            return response.content.decode('utf-8')
-        print(str(response.content))
-        return str(response.content)
+                    response.close()
+                    return b''
+                self._license_cache[study_id] = hash
+                response.raw.decode_content = True
+                head = response.raw.read(_LICENSE_PEEK)
+            if not head:
+                return b''
+            return _ResponseStream(head, response)
+        # error messages are short, don't copy a large body just to print it
+        print(response.content[:512].decode('utf-8', 'replace'))
+        return b''
 
-    def getStudies(self):
+    @staticmethod
+    def _parse_csv(raw, dtype=None, parse_dates=None, **kw):
+        # parse the API response with pandas' C reader, straight off the
+        # stream when there is one, or with pyarrow for large downloads
+        if isinstance(raw, bytes):
+            size = len(raw)
+            raw = io.BytesIO(raw)
+        else:
+            size = raw.length
+        if pacsv is not None and size > _ARROW_MIN_BYTES and not kw:
+            column_types = {
+                c: pa.from_numpy_dtype(np.dtype(t))
+                for c, t in (dtype or {}).items()
+            }
+            # like pandas, only parse the timestamps when asked to
+            column_types['timestamp'] = pa.timestamp(
+                'ns') if parse_dates else pa.string()
+            return MovebankAPI._parse_csv_arrow(raw, column_types)
+        df = pd.read_csv(raw,
+                         engine='c',
+                         dtype=dtype,
+                         parse_dates=parse_dates,
+                         **kw)
+        # recent pandas infers datetime64[us]; keep ns like the Arrow path
+        for col in parse_dates or []:
+            df[col] = df[col].astype('datetime64[ns]')
+        return df
+
+    @staticmethod
+    def _parse_csv_arrow(raw, column_types):
+        table = pacsv.read_csv(
+            raw,
+            read_options=pacsv.ReadOptions(use_threads=True,
+                                           block_size=8 << 20),
+            convert_options=pacsv.ConvertOptions(
+                column_types=column_types,
+                timestamp_parsers=[pacsv.ISO8601],
+                # empty cells are NaN, as with pandas
+                strings_can_be_null=True,
+                quoted_strings_can_be_null=True))
+        # all-empty columns are float NaN rather than object None in pandas
+        table = table.cast(
+            pa.schema([
+                f.with_type(pa.float64()) if pa.types.is_null(f.type) else f
+                for f in table.schema
+            ]))
+        return table.to_pandas(split_blocks=True, self_destruct=True)
+
+    def getStudies(self, sensor=None):
+        # sensor: only keep studies with this sensor name, e.g. 'GPS'
+        key = ('getStudies', sensor)
+        if key in self._cache:
+            return self._cache[key]
         studies = self.callMovebankAPI(
             (('entity_type', 'study'), ('i_can_see_data', 'true'),
              ('there_are_data_which_i_cannot_see', 'false')))
-        if len(studies) > 0:
-            # parse raw text to dicts
-            studies = csv.DictReader(io.StringIO(studies), delimiter=',')
-            all_studies = [
-                s for s in studies if s['i_can_see_data'] == 'true'
-                and s['there_are_data_which_i_cannot_see'] == 'false'
-            ]
-            return all_studies
+        if studies:
+            # keep the raw strings, callers compare against 'true'/'false'
+            df = self._parse_csv(studies, dtype=str, keep_default_na=False)
+            mask = ((df.i_can_see_data == 'true')
+                    & (df.there_are_data_which_i_cannot_see == 'false'))
+            if sensor is not None:
+                mask &= df.sensor_type_ids.str.contains(sensor, regex=False)
+            self._cache[key] = df[mask].to_dict('records')
+            return self._cache[key]
 
     @staticmethod
     def getStudiesBySensor(studies, sensorname='GPS'):
+        # for an already fetched list; prefer getStudies(sensor=...)
         return [s for s in studies if sensorname in s['sensor_type_ids']]
 
     def getIndividualsByStudy(self):
+        key = ('getIndividualsByStudy', self.study_id)
+        if key in self._cache:
+            return self._cache[key]
         individuals = self.callMovebankAPI(
             (('entity_type', 'individual'), ('study_id', self.study_id)))
-        if len(individuals) > 0:
-            return list(csv.DictReader(io.StringIO(individuals),
-                                       delimiter=','))
+        if individuals:
+            self._cache[key] = self._parse_csv(
+                individuals, dtype=str,
+                keep_default_na=False).to_dict('records')
+            return self._cache[key]
 
     def getIndividualEvents(self,
                             individual_id,
@@ -96,125 +287,149 @@ class MovebankAPI:
 		"","magnetometer",77740402,false,"Magnetometer"
 		"","orientation",819073350,false,"Orientation"
 		"","solar-geolocator-twilight",914097241,false,"Solar Geolocator Twilight"
+
+		Returns the events as a DataFrame. With transform=True, GPS events are
+		reduced to typed (timestamp, deployment_id, lat, long) columns and ACC
+		events are converted by transformRawACC.
 		"""
         params = (('entity_type', 'event'), ('study_id', self.study_id),
                   ('individual_id', individual_id),
                   ('sensor_type_id', sensor_type_id), ('attributes', 'all'))
         events_ = self.callMovebankAPI(params)
         if events_:
-            events = list(csv.DictReader(io.StringIO(events_), delimiter=','))
             if sensor_type_id == 653 and transform:
-                return self.transformRawGPS(events)
-            elif sensor_type_id == 2365683 and transform:
+                events = self._parse_csv(events_, parse_dates=['timestamp'])
+                # missing deployments and coordinates that cannot be parsed
+                # become NA instead of failing the whole download
+                events['deployment_id'] = pd.to_numeric(
+                    events['deployment_id'], errors='coerce').astype('Int32')
+                for col in ('location_lat', 'location_long'):
+                    events[col] = pd.to_numeric(events[col],
+                                                errors='coerce',
+                                                downcast='float')
+                # dimension reduction
+                return events[[
+                    'timestamp', 'deployment_id', 'location_lat',
+                    'location_long'
+                ]]
+            events = self._parse_csv(events_)
+            if sensor_type_id == 2365683 and transform:
                 return self.transformRawACC(events)
             else:
                 return events
 
-    @staticmethod
-    def transformRawGPS(gpsevents):
-        # Returns a list of (ts, deployment_id, lat, long) tuples
-
-        def transform(e):  # dimension reduction and data type conversion
-            try:
-                if len(e['location_lat']) > 0:
-                    e['location_lat'] = float(e['location_lat'])
-                if len(e['location_long']) > 0:
-                    e['location_long'] = float(e['location_long'])
-            except:
-                print("Could not parse long/lat.")
-            return e['timestamp'], e['deployment_id'], e['location_lat'], e[
-                'location_long']
-
-        return [transform(e) for e in gpsevents]
+    def getAllIndividualEvents(self,
+                               individual_ids,
+                               sensor_type_id=653,
+                               transform=False,
+                               max_workers=8):
+        # Fetches the events of several individuals concurrently over the
+        # pooled session; results keep the order of individual_ids.
+        with ThreadPoolExecutor(max_workers) as ex:
+            return list(
+                ex.map(
+                    lambda i: self.getIndividualEvents(
+                        i, sensor_type_id, transform), individual_ids))
 
     @staticmethod
     def transformRawACC(accevents, unit='m/s2', sensitivity='high'):
-        #  Transforms raw tri-axial acceleration from X Y Z X Y X Y Z to [(ts_interpol,
-        # deployment, X', Y', Z'),...]
+        #  Transforms raw tri-axial acceleration from X Y Z X Y X Y Z to one
+        # DataFrame of (ts_interpol, deployment, X', Y', Z') rows for all bursts
         #  X', Y', Z' are in m/s^2 or g. Assumes e-obs acceleration sensors.
         #  Acknowledgments to Anne K. Scharf and her great moveACC package, see
         # https://gitlab.com/anneks/moveACC
 
-        ts_format = '%Y-%m-%d %H:%M:%S.%f'
-        out = []
-
         if unit == 'g':
             unitfactor = 1
         else:
             unitfactor = 9.81
 
-        tag_local_identifier = int(accevents[0]['tag_local_identifier'])
-        slope = 0.001  # e-obs 1st generation, high sensitivity
+        slope = _pick_slope(int(accevents['tag_local_identifier'].iloc[0]),
+                            sensitivity)
 
-        if tag_local_identifier <= 2241:
-            if sensitivity == 'low':
-                slope = 0.0027
-        elif 2242 <= tag_local_identifier <= 4117:  # e-obs 2nd generation
-            slope = 0.0022
-        else:
-            slope = 1 / 512
-
-        for event in accevents:
-            deploym = event['deployment_id']
-            seconds = 1 / float(
-                event['acceleration_sampling_frequency_per_axis'])
-            parsedts = datetime.strptime(event['timestamp'],
-                                         ts_format)  # start timestamp
-            raw = list(map(int, event['accelerations_raw'].split()))
-
-            #  derive in-between timestamps:
-            ts = [
-                parsedts + timedelta(seconds=seconds * x)
-                for x in range(0, int(len(raw) / 3))
-            ]
-
-            #  transform XYZ list to list of (ts, deployment, x, y, z) tuples
-            it = iter(raw)
-            transformed = [(a.strftime(ts_format), deploym,
-                            (b[0] - 2048) * slope * unitfactor,
-                            (b[1] - 2048) * slope * unitfactor,
-                            (b[2] - 2048) * slope * unitfactor)
-                           for (a, b) in list(zip(ts, list(zip(it, it, it))))]
-            out.append(transformed)
-        return out
+        #  parse the samples of all bursts in a single C loop; the 12-bit
+        # ADC values fit into int16
+        bursts = accevents['accelerations_raw'].fillna('')
+        tokens = bursts.str.count(r'\S+').to_numpy()
+        raw = np.fromstring(' '.join(bursts[tokens > 0]),
+                            sep=' ',
+                            dtype=np.int16)
+        if len(raw) != tokens.sum():
+            raise ValueError('Could not parse accelerations_raw.')
+        counts = tokens // 3
+        if (tokens % 3).any():
+            #  drop the incomplete trailing sample of a burst, so that it
+            # does not shift the axes of the following bursts
+            pos = np.arange(len(raw)) - np.repeat(
+                np.cumsum(tokens) - tokens, tokens)
+            raw = raw[pos < np.repeat(counts * 3, tokens)]
+        n = len(raw) // 3
+
+        #  transform XYZ samples of all bursts into shared output buffers
+        acc_x = np.empty(n, dtype=np.float32)
+        acc_y = np.empty(n, dtype=np.float32)
+        acc_z = np.empty(n, dtype=np.float32)
+        k = np.float32(slope * unitfactor)
+        _acc_convert(raw, 2048, k, acc_x, acc_y, acc_z)
+
+        #  derive in-between timestamps from each burst's start timestamp,
+        # parsing every distinct start only once
+        codes, uniq = pd.factorize(accevents['timestamp'])
+        starts = np.array([_parse_ts(t) for t in uniq],
+                          dtype='datetime64[ns]')[codes]
+        step_us = 1e6 / accevents[
+            'acceleration_sampling_frequency_per_axis'].to_numpy(float)
+        sample = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+        ts = np.repeat(starts, counts) + np.rint(
+            sample * np.repeat(step_us, counts)).astype('timedelta64[us]')
+
+        # a missing deployment becomes NA, as on the GPS path
+        deploym = pd.to_numeric(accevents['deployment_id'],
+                                errors='coerce').astype('Int32').repeat(
+                                    counts).array
+        return pd.DataFrame({
+            'timestamp': ts,
+            'deployment_id': deploym,
+            'AccX': acc_x,
+            'AccY': acc_y,
+            'AccZ': acc_z
+        })
 
     @staticmethod
     def _pprint(list_):
-        print(json.dumps(list_, indent=4))
+        if isinstance(list_, pd.DataFrame):
+            list_ = list_.to_dict('records')
+        print(json.dumps(list_, indent=4, default=str))
 
     @staticmethod
     def to_pandas(list_, sensor_type=None, save_to=None, transformed=False):
         if sensor_type and sensor_type.lower() == 'acc' and transformed:
-            arr = np.array(list_)
-            m, n, r = arr.shape
-            out_arr = np.column_stack((np.repeat(np.arange(m),
-                                                 n), arr.reshape(m * n, -1)))
-            df = pd.DataFrame(
-                out_arr,
-                columns=[
-                    'idx', 'timestamp', 'deployment_id', 'AccX', 'AccY', 'AccZ'
-                ],
-            )
-            df.drop(columns=['idx'], inplace=True)
-            df = df.astype({
-                'timestamp': 'datetime64[ns]',
-                'deployment_id': 'int32',
-                'AccX': 'float32',
-                'AccY': 'float32',
-                'AccZ': 'float32'
-            })
+            if isinstance(list_, pd.DataFrame):
+                # already typed by transformRawACC
+                df = list_
+            else:
+                df = pd.concat(list_, ignore_index=True)
         elif sensor_type and sensor_type.lower() == 'gps' and transformed:
-            df = pd.DataFrame(list_,
-                              columns=[
-                                  'timestamp', 'deployment_id', 'location_lat',
-                                  'location_long'
-                              ])
-            df = df.astype({
-                'timestamp': 'datetime64[ns]',
-                'deployment_id': 'int32',
-                'location_lat': 'float32',
-                'location_long': 'float32'
-            })
+            if isinstance(list_, pd.DataFrame):
+                # already typed by getIndividualEvents
+                df = list_
+            else:
+                # (ts, deployment_id, lat, long) tuples: build each column
+                # with its final dtype instead of inferring and casting
+                n = len(list_)
+                df = pd.DataFrame(
+                    {
+                        'timestamp':
+                        np.array([r[0] for r in list_],
+                                 dtype='datetime64[ns]'),
+                        'deployment_id':
+                        np.fromiter((r[1] for r in list_), np.int32, n),
+                        'location_lat':
+                        np.fromiter((r[2] for r in list_), np.float32, n),
+                        'location_long':
+                        np.fromiter((r[3] for r in list_), np.float32, n)
+                    },
+                    copy=False)
         else:
             df = pd.DataFrame(list_)
         if save_to: